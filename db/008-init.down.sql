@@ -0,0 +1,3 @@
+DROP INDEX IF EXISTS immature_mining_rewards_rollback;
+DROP MATERIALIZED VIEW IF EXISTS unpaid_mining_rewards CASCADE;
+ALTER TABLE payment_transactions DROP COLUMN IF EXISTS nonce;
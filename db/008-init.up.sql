@@ -0,0 +1,16 @@
+/* unpaid mining rewards, refreshed by the payer before each payout */
+CREATE MATERIALIZED VIEW unpaid_mining_rewards AS
+  SELECT m.pool_name, m.mining_round, m.holder, m.mcb_balance - coalesce(r.paid_amount, 0) AS unpaid_amount
+  FROM mature_mining_rewards m
+  LEFT JOIN round_payment_summaries r
+    ON m.pool_name = r.pool_name AND m.mining_round = r.mining_round AND m.holder = r.holder
+  WHERE m.mcb_balance - coalesce(r.paid_amount, 0) != 0;
+
+/* required by REFRESH MATERIALIZED VIEW CONCURRENTLY */
+CREATE UNIQUE INDEX unpaid_mining_rewards_key ON unpaid_mining_rewards (mining_round, holder, pool_name);
+
+/* nonce of the payout transaction */
+ALTER TABLE payment_transactions ADD COLUMN nonce int;
+
+/* rewards after a block of one round, read by the rollback without visiting the table */
+CREATE INDEX immature_mining_rewards_rollback ON immature_mining_rewards (mining_round, block_number) INCLUDE (pool_name, holder, mcb_balance);
@@ -7,13 +7,18 @@ ETH_RPC_TIMEOUT = 10
 # mining MCB 
 MINING_ROUND = os.environ.get('MINING_ROUND', 'XIA')
 MAX_PATCH_NUM = os.environ.get('MAX_PATCH_NUM', 100)
-WAIT_TIMEOUT = os.environ.get('WAIT_TIMEOUT', 600)
+WAIT_TIMEOUT = float(os.environ.get('WAIT_TIMEOUT', 600))
+POLL_LATENCY = float(os.environ.get('POLL_LATENCY', 2)) # 2 sec
 MIN_PAY_AMOUNT = os.environ.get('MIN_PAY_AMOUNT', 1)
 PAY_ALL = os.environ.get('PAY_ALL', False)
+NONCE_CONTINGENT_SIZE = int(os.environ.get('NONCE_CONTINGENT_SIZE', 100))
 
 # db
 DB_URL = os.environ.get('DB_URL', '')
 DB_ECHO = os.environ.get('DB_ECHO', False)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 25))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 25))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600)) # 1 hour
 
 # gas price
 GAS_LEVEL = os.environ.get('GAS_LEVEL', 'fast')
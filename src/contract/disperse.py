@@ -1,3 +1,5 @@
+import eth_abi
+from eth_utils import function_signature_to_4byte_selector
 from web3 import Web3
 
 from lib.contract import Contract
@@ -8,6 +10,10 @@ from lib.wad import Wad
 class Disperse(Contract):
     abi = Contract._load_abi(__name__, '../abi/disperse.abi')
     registry = {}
+    # disperseToken is sent once per payout batch, encode its calldata without walking the abi
+    disperse_token_types = ['address', 'address[]', 'uint256[]']
+    disperse_token_selector = function_signature_to_4byte_selector(
+        f"disperseToken({','.join(disperse_token_types)})")
 
     def __init__(self, web3: Web3, address: Address):
         assert(isinstance(web3, Web3))
@@ -18,26 +24,28 @@ class Disperse(Contract):
         self.contract = self._get_contract(web3, self.abi, address)
 
     def disperse_ether(self, addresses: list, amounts: list, user: Address, gasPrice: int):
-        total_amount = 0
-        amounts_toWei = []
-        for amount in amounts:
-            amount_toWei = self.web3.toWei(amount, 'ether')
-            amounts_toWei.append(amount_toWei)
-            total_amount += amount_toWei
-        tx_hash = self.contract.functions.disperseEther(addresses, amounts).transact({
+        amounts_toWei = [self.web3.toWei(amount, 'ether') for amount in amounts]
+        total_amount = sum(amounts_toWei)
+        tx_hash = self.contract.functions.disperseEther(addresses, amounts_toWei).transact({
             'from': user.address,
             'value': self.web3.toHex(total_amount),
             'gasPrice': gasPrice
         })
         return tx_hash
 
-    def disperse_token(self, token: Address, addresses: list, amounts: list, user: Address, gasPrice: int):
-        amounts_toWad = []
-        for amount in amounts:
-            amounts_toWad.append(Wad.from_number(amount).value)
-        tx_hash = self.contract.functions.disperseToken(token.address, addresses, amounts_toWad).transact({
+    def disperse_token(self, token: Address, addresses: list, amounts: list, user: Address, gasPrice: int, nonce: int = None):
+        amounts_toWad = [Wad.from_number(amount).value for amount in amounts]
+        data = self.disperse_token_selector + eth_abi.encode_abi(self.disperse_token_types,
+                                                                 [token.address, addresses, amounts_toWad])
+        # gas is estimated by sendTransaction
+        transaction = {
+            'to': self.address.address,
             'from': user.address,
+            'data': self.web3.toHex(data),
             'gasPrice': gasPrice
-        })
+        }
+        if nonce is not None:
+            transaction['nonce'] = nonce
+        tx_hash = self.web3.eth.sendTransaction(transaction)
         return tx_hash
     
\ No newline at end of file
@@ -1,3 +1,4 @@
+import functools
 import logging
 import json
 import pkg_resources
@@ -23,5 +24,6 @@ class Contract:
         return web3.eth.contract(address=address.address, abi=abi)
 
     @staticmethod
+    @functools.lru_cache(maxsize=None)
     def _load_abi(package, resource) -> list:
         return json.loads(pkg_resources.resource_string(package, resource))
@@ -1,7 +1,17 @@
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 import config
 
-db_engine = create_engine(config.DB_URL, echo=config.DB_ECHO)
-DBSession = sessionmaker(bind=db_engine)
+engine_options = {}
+if make_url(config.DB_URL).get_backend_name() != 'sqlite':
+    # sqlite keeps its default pool, the queue pool options are for the postgres server
+    engine_options = {
+        'pool_size': config.DB_POOL_SIZE,
+        'max_overflow': config.DB_MAX_OVERFLOW,
+        'pool_pre_ping': True,
+        'pool_recycle': config.DB_POOL_RECYCLE,
+    }
+db_engine = create_engine(config.DB_URL, echo=config.DB_ECHO, **engine_options)
+DBSession = scoped_session(sessionmaker(bind=db_engine))
@@ -123,6 +123,15 @@ class MatureMiningRewardCheckpoint(Base):
     mcb_balance = Column(DECIMAL(78, 18))
 
 
+class UnpaidMiningReward(Base):
+    __tablename__ = "unpaid_mining_rewards"
+
+    pool_name = Column(String, primary_key=True)
+    mining_round = Column(String, primary_key=True)
+    holder = Column(String, primary_key=True)
+    unpaid_amount = Column(DECIMAL(78, 18))
+
+
 class PaymentTransaction(Base):
     __tablename__ = "payment_transactions"
     FAILED = "FAILED"
@@ -132,6 +141,7 @@ class PaymentTransaction(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     transaction_data = Column(String)
     transaction_hash = Column(String, nullable=True)
+    nonce = Column(Integer, nullable=True)
     status = Column(String, nullable=True)
 
     payments = relationship("Payment")
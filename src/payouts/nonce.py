@@ -0,0 +1,47 @@
+import logging
+import threading
+
+from web3 import Web3
+
+from lib.address import Address
+
+
+class NonceManager:
+    """Hands out contingents of consecutive nonces for one account.
+
+    Every caller gets its own [start, end) range, so several transactions can be signed and sent
+    without waiting for the previous one to be mined. The counter starts from the account's
+    pending transaction count on the node.
+    """
+
+    def __init__(self, web3: Web3, address: Address):
+        assert(isinstance(web3, Web3))
+        assert(isinstance(address, Address))
+
+        self._web3 = web3
+        self._address = address
+        self._lock = threading.Lock()
+        self._next_nonce = None
+        self._logger = logging.getLogger()
+
+    def _get_pending_nonce(self) -> int:
+        return self._web3.eth.getTransactionCount(self._address.address, 'pending')
+
+    def allocate(self, n: int):
+        """allocate n consecutive nonces
+
+        Returns:
+            (start, end): the nonces start, start + 1, ..., end - 1 belong to the caller
+        """
+        with self._lock:
+            if self._next_nonce is None:
+                self._next_nonce = self._get_pending_nonce()
+            start = self._next_nonce
+            self._next_nonce += n
+            self._logger.info(f'allocate nonce from {start} to {self._next_nonce} for {self._address}')
+            return start, self._next_nonce
+
+    def reset(self):
+        """drop the counter, the next allocation starts from the node's pending transaction count again"""
+        with self._lock:
+            self._next_nonce = None
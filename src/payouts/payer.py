@@ -3,11 +3,16 @@ import json
 import logging
 import logging.config
 import requests
+from requests.adapters import HTTPAdapter
 import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
-from sqlalchemy import desc, and_
+from psycopg2.extras import execute_values
+from sqlalchemy import desc
 
 from web3 import Web3, HTTPProvider
+from web3.exceptions import TimeExhausted, TransactionNotFound
 from eth_account import Account
 from web3.middleware import construct_sign_and_send_raw_middleware, geth_poa_middleware
 
@@ -17,7 +22,17 @@ from lib.contract import Contract
 from lib.wad import Wad
 from contract.disperse import Disperse
 from contract.erc20 import ERC20Token
-from model import DBSession, PaymentTransaction, Payment, RoundPayment, PaymentSummary, RoundPaymentSummary, MatureMiningReward
+from .nonce import NonceManager
+from model import DBSession, Payment, PaymentTransaction, PaymentSummary, RoundPayment, RoundPaymentSummary, UnpaidMiningReward
+
+# node errors which mean the nonce is out of sync with the account
+NONCE_ERRORS = ("nonce too low", "nonce too high", "replacement transaction underpriced")
+MAX_NONCE_RETRY = 3
+
+# keep the gas price connection alive between fetches
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
 
 class Payer:
     def __init__(self):
@@ -29,8 +44,12 @@ class Payer:
                         request_kwargs={"timeout": config.ETH_RPC_TIMEOUT}))
         self._web3.middleware_onion.inject(geth_poa_middleware, layer=0)
         self._gas_price = self._web3.toWei(50, "gwei")
-        self._get_gas_price()
         self._payer_account = None
+        self._db = DBSession
+        self._nonce_manager = None
+        # local nonce contingent [_nonce, _nonce_end)
+        self._nonce = 0
+        self._nonce_end = 0
 
         # contract
         self._disperse = Disperse(
@@ -40,7 +59,7 @@ class Payer:
 
     def _get_gas_price(self):
         try:
-            resp = requests.get(config.ETH_GAS_URL, timeout=60)
+            resp = _SESSION.get(config.ETH_GAS_URL, timeout=5)
             if resp.status_code / 100 == 2:
                 rsp = json.loads(resp.content)
                 self._gas_price = self._web3.toWei(
@@ -56,13 +75,57 @@ class Payer:
             self._web3.middleware_onion.add(
                 construct_sign_and_send_raw_middleware(acct))
             self._payer_account = Address(acct.address)
+            self._nonce_manager = NonceManager(self._web3, self._payer_account)
         except:
             self._logger.fatal(f"Account {config.PAYER_ADDRESS} register key error")
             return False
         return True
 
+    def _get_nonce(self):
+        """the nonce for the next transaction, consumed by _use_nonce once the transaction is sent"""
+        if self._nonce >= self._nonce_end:
+            self._nonce, self._nonce_end = self._nonce_manager.allocate(config.NONCE_CONTINGENT_SIZE)
+        return self._nonce
+
+    def _use_nonce(self):
+        self._nonce += 1
+
+    def _reset_nonce(self):
+        self._nonce_manager.reset()
+        self._nonce = 0
+        self._nonce_end = 0
+
+    def _prepare_transaction(self):
+        """fetch gas price and the first nonce contingent in parallel"""
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                gas_price = executor.submit(self._get_gas_price)
+                nonce = executor.submit(self._get_nonce)
+                gas_price.result()
+                nonce.result()
+        except Exception as e:
+            self._logger.fatal(f"prepare transaction fail! err:{e}")
+            return False
+        return True
+
+    def _send_disperse_transaction(self, miners, amounts):
+        for _ in range(MAX_NONCE_RETRY):
+            nonce = self._get_nonce()
+            try:
+                tx_hash = self._disperse.disperse_token(self._MCBToken.address, miners, amounts,
+                    self._payer_account, self._gas_price, nonce)
+            except ValueError as e:
+                if any(error in str(e).lower() for error in NONCE_ERRORS):
+                    self._logger.warning(f"disperse transaction nonce {nonce} error:{e}, resync nonce and retry")
+                    self._reset_nonce()
+                    continue
+                raise
+            self._use_nonce()
+            return tx_hash, nonce
+        raise Exception(f"nonce still out of sync after {MAX_NONCE_RETRY} retries")
+
     def _restore_pending_data(self):
-        db_session = DBSession()
+        db_session = self._db()
         transaction = db_session.query(PaymentTransaction)\
             .filter_by(status = PaymentTransaction.PENDING).first()
         data = json.loads(transaction.transaction_data)
@@ -74,18 +137,89 @@ class Payer:
 
         return data, data["pool_amounts"]
 
+    def _wait_for_receipts(self, tx_hashes):
+        """wait for the receipts of tx_hashes, they are only fetched again when a new block arrives
+
+        Without a block filter, e.g. the node does not support it or drops it, the receipts are polled every POLL_LATENCY.
+        A failed receipt lookup is retried on the next poll and only affects its own transaction.
+
+        Returns:
+            receipts in the order of tx_hashes, None for a transaction not mined in WAIT_TIMEOUT
+        """
+        if len(tx_hashes) == 0:
+            return []
+        receipts = {}
+        block_filter = self._install_block_filter()
+        try:
+            deadline = time.monotonic() + config.WAIT_TIMEOUT
+            # the transactions may be mined already
+            new_block = True
+            while True:
+                if new_block:
+                    for tx_hash in tx_hashes:
+                        if tx_hash in receipts:
+                            continue
+                        try:
+                            receipts[tx_hash] = self._web3.eth.getTransactionReceipt(tx_hash)
+                        except TransactionNotFound:
+                            pass
+                        except Exception as e:
+                            self._logger.warning(f"get transaction receipt fail, retry later! tx_hash:{tx_hash}, err:{e}")
+                    if len(receipts) == len(tx_hashes) or time.monotonic() > deadline:
+                        break
+                time.sleep(config.POLL_LATENCY)
+                if block_filter is None:
+                    new_block = True
+                    continue
+                try:
+                    new_block = len(block_filter.get_new_entries()) > 0 or time.monotonic() > deadline
+                except Exception as e:
+                    self._logger.warning(f"get new blocks fail, poll receipts every {config.POLL_LATENCY} seconds! err:{e}")
+                    block_filter = None
+                    new_block = True
+        finally:
+            self._uninstall_block_filter(block_filter)
+        return [receipts.get(tx_hash) for tx_hash in tx_hashes]
+
+    def _install_block_filter(self):
+        try:
+            return self._web3.eth.filter('latest')
+        except Exception as e:
+            self._logger.warning(f"install block filter fail, poll receipts every {config.POLL_LATENCY} seconds! err:{e}")
+            return None
+
+    def _uninstall_block_filter(self, block_filter):
+        if block_filter is None:
+            return
+        try:
+            self._web3.eth.uninstallFilter(block_filter.filter_id)
+        except Exception as e:
+            self._logger.warning(f"uninstall block filter fail! err:{e}")
+
     def _check_pending_transactions(self) -> bool:
-        db_session = DBSession()
+        db_session = self._db()
         pending_transactions = db_session.query(PaymentTransaction)\
             .filter_by(status = PaymentTransaction.PENDING).all()
-        for transaction in pending_transactions:
+        if len(pending_transactions) == 0:
+            return True
+
+        # wait for all pending transactions at the same time, the receipts are handled in order below
+        try:
+            tx_receipts = self._wait_for_receipts(
+                [transaction.transaction_hash for transaction in pending_transactions])
+        except Exception as e:
+            self._logger.fatal(f"wait pending transactions fail! err:{e}")
+            return False
+
+        for transaction, tx_receipt in zip(pending_transactions, tx_receipts):
             try:
-                tx_receipt = self._web3.eth.waitForTransactionReceipt(transaction.transaction_hash, timeout=config.WAIT_TIMEOUT)
+                if tx_receipt is None:
+                    raise TimeExhausted(f"transaction is not mined in {config.WAIT_TIMEOUT} seconds")
                 data = json.loads(transaction.transaction_data)
                 amounts = []
                 for amount in data["amounts"]:
                     amounts.append(Decimal(amount))
-                self._save_payments_info(tx_receipt, data["miners"], amounts, data["pool_amounts"])
+                self._save_payments_info(tx_receipt, transaction, data["miners"], amounts, data["pool_amounts"])
             except Exception as e:
                 self._logger.fatal(
                     f"get trasaction fail! tx_hash:{transaction.transaction_hash}, err:{e}")
@@ -93,11 +227,11 @@ class Payer:
 
         return True
 
-    def _save_payment_transaction(self, tx_hash, miners, amounts, miner_pool_amount):
+    def _save_payment_transaction(self, tx_hash, nonce, miners, amounts, miner_pool_amount):
         amounts_str = []
         for amount in amounts:
             amounts_str.append(str(amount))
-        db_session = DBSession()
+        db_session = self._db()
         try:
             pt = PaymentTransaction()
             data = {
@@ -105,31 +239,33 @@ class Payer:
                 "amounts": amounts_str,
                 "pool_amounts": miner_pool_amount,
             }
-            pt.transaction_data = json.dumps(data)
+            pt.transaction_data = json.dumps(data, separators=(",", ":"))
             pt.transaction_hash = tx_hash
+            pt.nonce = nonce
             # 0: failed, 1: success, 2: pending
             pt.transaction_status(2)
             db_session.add(pt)
             db_session.commit()
+            return pt
         except Exception as e:
-            self._logger.warning(f'save payment transaction fail! err:{e}')
-        finally:
             db_session.rollback()
+            self._logger.warning(f'save payment transaction fail! err:{e}')
 
-    def _save_payments_info(self, tx_receipt, miners, amounts, miner_pool_amount):
-        db_session = DBSession()
+    def _save_payments_info(self, tx_receipt, pt, miners, amounts, miner_pool_amount):
+        db_session = self._db()
         try:
             # update transaction status
-            pt = db_session.query(PaymentTransaction)\
-                .filter_by(transaction_hash=self._web3.toHex(tx_receipt["transactionHash"])).first()
             pt.transaction_status(tx_receipt["status"])
-            db_session.add(pt)
 
             # save payments
             if pt.status == PaymentTransaction.SUCCESS:
-                miner_payments = db_session.query(PaymentSummary).all()
+                # only the summaries of this batch's miners are updated
+                holders = [miner.lower() for miner in miners]
+                miner_payments = db_session.query(PaymentSummary)\
+                                        .filter(PaymentSummary.holder.in_(holders)).all()
                 miner_round_payments = db_session.query(RoundPaymentSummary)\
-                                        .filter_by(mining_round = config.MINING_ROUND).all()
+                                        .filter_by(mining_round = config.MINING_ROUND)\
+                                        .filter(RoundPaymentSummary.holder.in_(holders)).all()
 
                 payments_map = {}
                 for payment in miner_payments:
@@ -140,72 +276,82 @@ class Payer:
                         round_payments_map[round_payment.pool_name] = {}
                     round_payments_map[round_payment.pool_name][round_payment.holder] = round_payment
 
+                round_payments = []
                 for miner, rewards in miner_pool_amount.items():
+                    holder = miner.lower()
                     for pool_name, reward in rewards.items():
                         # save round payments
-                        rp = RoundPayment()
-                        rp.mining_round = config.MINING_ROUND
-                        rp.pool_name = pool_name
-                        rp.holder = miner.lower()
-                        rp.amount = Decimal(reward)
-                        rp.transaction_id = pt.id
-                        db_session.add(rp)
+                        amount = Decimal(reward)
+                        round_payments.append((config.MINING_ROUND, pool_name, holder, amount, pt.id))
                         # update round payment summaries
-                        pool_round_summary = round_payments_map.get(rp.pool_name)
+                        pool_round_summary = round_payments_map.get(pool_name)
                         miner_round_summary = None
                         if pool_round_summary is not None:
-                            miner_round_summary = pool_round_summary.get(rp.holder)
+                            miner_round_summary = pool_round_summary.get(holder)
                         if miner_round_summary is not None:
-                            miner_round_summary.paid_amount += rp.amount
+                            miner_round_summary.paid_amount += amount
                         else:
                             miner_round_summary = RoundPaymentSummary()
                             miner_round_summary.pool_name = pool_name
-                            miner_round_summary.mining_round = rp.mining_round
-                            miner_round_summary.holder = rp.holder
-                            miner_round_summary.paid_amount = rp.amount
+                            miner_round_summary.mining_round = config.MINING_ROUND
+                            miner_round_summary.holder = holder
+                            miner_round_summary.paid_amount = amount
                         db_session.add(miner_round_summary)
 
+                payments = []
+                pay_time = datetime.datetime.utcnow()
                 for i in range(len(miners)):
                     # save payments
-                    p = Payment()
-                    p.holder = miners[i].lower()
-                    p.amount = amounts[i]
-                    p.pay_time = datetime.datetime.utcnow()
-                    p.transaction_id = pt.id
-                    db_session.add(p)
+                    holder = miners[i].lower()
+                    payments.append((holder, amounts[i], pay_time, pt.id))
 
                     # update payment summaries
-                    payment_summary = payments_map.get(p.holder)
+                    payment_summary = payments_map.get(holder)
                     if payment_summary is not None:
-                        payment_summary.paid_amount += p.amount
+                        payment_summary.paid_amount += amounts[i]
                     else:
                         payment_summary = PaymentSummary()
-                        payment_summary.holder = p.holder
-                        payment_summary.paid_amount = p.amount
+                        payment_summary.holder = holder
+                        payment_summary.paid_amount = amounts[i]
                     db_session.add(payment_summary)
 
+                # payments are only inserted, write them with one multi-row INSERT each
+                with db_session.connection().connection.cursor() as cursor:
+                    execute_values(cursor,
+                        f"INSERT INTO {RoundPayment.__table__.name} (mining_round, pool_name, holder, amount, transaction_id) VALUES %s",
+                        round_payments)
+                    execute_values(cursor,
+                        f"INSERT INTO {Payment.__table__.name} (holder, amount, pay_time, transaction_id) VALUES %s",
+                        payments)
+
             else:
                 self._logger.warning(
                     f"transaction not success! tx_receipt:{tx_receipt}")
 
             db_session.commit()
         except Exception as e:
+            db_session.rollback()
             self._logger.warning(f'save payment info fail! err:{e}')
             # raise exception for _check_pending_transactions
             raise
-        finally:
+
+    def _refresh_unpaid_reward(self):
+        db_session = self._db()
+        try:
+            db_session.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY unpaid_mining_rewards")
+            db_session.commit()
+        except Exception as e:
             db_session.rollback()
+            self._logger.fatal(f'refresh unpaid mining rewards fail! err:{e}')
+            return False
+        return True
 
     def _get_miner_unpaid_reward(self):
-        db_session = DBSession()
-        items = db_session.query(MatureMiningReward)\
-                        .outerjoin(RoundPaymentSummary, and_(
-                                MatureMiningReward.pool_name == RoundPaymentSummary.pool_name,
-                                MatureMiningReward.mining_round == RoundPaymentSummary.mining_round,
-                                MatureMiningReward.holder == RoundPaymentSummary.holder))\
-                        .filter(MatureMiningReward.mining_round == config.MINING_ROUND)\
-                        .with_entities(MatureMiningReward.pool_name, MatureMiningReward.holder, MatureMiningReward.mcb_balance, RoundPaymentSummary.paid_amount)\
-                        .all()
+        db_session = self._db()
+        items = db_session.query(UnpaidMiningReward)\
+                        .filter(UnpaidMiningReward.mining_round == config.MINING_ROUND)\
+                        .with_entities(UnpaidMiningReward.pool_name, UnpaidMiningReward.holder, UnpaidMiningReward.unpaid_amount)\
+                        .yield_per(1000)
 
         result = {
             "miners":[],
@@ -214,9 +360,7 @@ class Payer:
         db_result = {}
         miner_unpaid = {}
         for item in items:
-            unpaid = item.mcb_balance
-            if item.paid_amount is not None:
-                unpaid = item.mcb_balance - item.paid_amount
+            unpaid = item.unpaid_amount
             if db_result.get(item.holder) is None:
                 db_result[item.holder] = {}
             db_result[item.holder][item.pool_name] = str(unpaid)
@@ -228,12 +372,19 @@ class Payer:
 
         for miner, unpaid in miner_unpaid.items():
             if (config.PAY_ALL and unpaid > Decimal(0)) or unpaid >= Decimal(config.MIN_PAY_AMOUNT):
-                result["miners"].append(self._web3.toChecksumAddress(miner))
+                # holders are stored in lower case, eth_abi accepts them without a checksum
+                result["miners"].append(miner)
                 result["amounts"].append(unpaid)
                 self._logger.info(f'miner {miner} unpaid rewards {unpaid}')
         return result, db_result
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            self._db.remove()
+
+    def _run(self):
         if self._check_account_from_key() is False:
             return
         
@@ -249,6 +400,8 @@ class Payer:
             return
         
         # get all miners unpaid rewards
+        if self._refresh_unpaid_reward() is False:
+            return
         unpaid_rewards, db_result = self._get_miner_unpaid_reward()
         miners_count = len(unpaid_rewards["miners"])
         if miners_count == 0:
@@ -265,9 +418,11 @@ class Payer:
             self._logger.info(f"input is {admin_input}. payer stop!")
             return
 
-        # get gas price for transaction
-        self._get_gas_price()
-        # send MCB to all accounts
+        # get gas price and nonce for transaction
+        if self._prepare_transaction() is False:
+            return
+        # send MCB to all accounts, every batch gets the next nonce and is sent without waiting for the previous one
+        sent_transactions = []
         for i in range(math.ceil(miners_count/config.MAX_PATCH_NUM)):
             start_idx = i*config.MAX_PATCH_NUM
             end_idx = min((i+1)*config.MAX_PATCH_NUM, miners_count)
@@ -280,16 +435,24 @@ class Payer:
                 miner = miner.lower()
                 miner_pool_amount[miner] = db_result.get(miner)
             try:
-                tx_hash = self._disperse.disperse_token(self._MCBToken.address, miners, amounts,
-                    self._payer_account, self._gas_price)
-                self._save_payment_transaction(self._web3.toHex(tx_hash), miners, amounts, miner_pool_amount)
+                tx_hash, nonce = self._send_disperse_transaction(miners, amounts)
+                pt = self._save_payment_transaction(self._web3.toHex(tx_hash), nonce, miners, amounts, miner_pool_amount)
             except Exception as e:
                 self._logger.fatal(f"disperse transaction fail! Exception:{e}")
                 continue
+            sent_transactions.append((tx_hash, pt, miners, amounts, miner_pool_amount))
 
+        # wait for the transactions in flight
+        try:
+            tx_receipts = self._wait_for_receipts([transaction[0] for transaction in sent_transactions])
+        except Exception as e:
+            self._logger.fatal(f"wait disperse transactions fail! err:{e}")
+            return
+        for (tx_hash, pt, miners, amounts, miner_pool_amount), tx_receipt in zip(sent_transactions, tx_receipts):
             try:
-                tx_receipt = self._web3.eth.waitForTransactionReceipt(tx_hash, timeout=config.WAIT_TIMEOUT)
-                self._save_payments_info(tx_receipt, miners, amounts, miner_pool_amount)
+                if tx_receipt is None:
+                    raise TimeExhausted(f"transaction is not mined in {config.WAIT_TIMEOUT} seconds")
+                self._save_payments_info(tx_receipt, pt, miners, amounts, miner_pool_amount)
             except Exception as e:
                 self._logger.fatal(
                     f"get trasaction receipt fail! tx_hash:{tx_hash}, err:{e}")
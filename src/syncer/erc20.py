@@ -120,7 +120,6 @@ class ERC20Tracer(SyncerInterface):
                 self._logger.error(f'opps, rollback update token_balance error, can not find item:{item}')
             else:
                 token_balance_item.balance -= item.amount
-                db_session.add(token_balance_item)
         
         db_session.query(TokenEvent).filter(TokenEvent.token == self._token_address).filter(TokenEvent.watcher_id == watcher_id).\
             filter(TokenEvent.block_number > block_number).delete(synchronize_session=False)
@@ -10,6 +10,8 @@ from watcher import Watcher
 
 from .types import SyncerInterface
 
+_ROLLBACK_BATCH_SIZE = 1000
+
 
 class MatureChecker(SyncerInterface):
     """Checking, then convert immature token into mature token
@@ -152,12 +154,24 @@ class MatureChecker(SyncerInterface):
             items = db_session.query(MatureMiningRewardCheckpoint)\
                 .filter(MatureMiningRewardCheckpoint.mining_round == self._mining_round)\
                 .filter(MatureMiningRewardCheckpoint.block_number == checkpoint_latest_block_number)\
-                .all()
+                .with_entities(
+                    MatureMiningRewardCheckpoint.pool_name,
+                    MatureMiningRewardCheckpoint.block_number,
+                    MatureMiningRewardCheckpoint.mining_round,
+                    MatureMiningRewardCheckpoint.holder,
+                    MatureMiningRewardCheckpoint.mcb_balance
+            ).yield_per(_ROLLBACK_BATCH_SIZE)
+            # stream the checkpoint and insert it back in batches, only one batch is kept in memory
+            mature_mining_rewards = []
             for item in items:
-                mature_mining_reward = MatureMiningReward()
-                mature_mining_reward.pool_name = item.pool_name
-                mature_mining_reward.block_number = item.block_number
-                mature_mining_reward.mining_round = item.mining_round
-                mature_mining_reward.holder = item.holder
-                mature_mining_reward.mcb_balance = item.mcb_balance
-                db_session.add(mature_mining_reward)
\ No newline at end of file
+                mature_mining_rewards.append({
+                    'pool_name': item.pool_name,
+                    'block_number': item.block_number,
+                    'mining_round': item.mining_round,
+                    'holder': item.holder,
+                    'mcb_balance': item.mcb_balance,
+                })
+                if len(mature_mining_rewards) >= _ROLLBACK_BATCH_SIZE:
+                    db_session.bulk_insert_mappings(MatureMiningReward, mature_mining_rewards)
+                    mature_mining_rewards = []
+            db_session.bulk_insert_mappings(MatureMiningReward, mature_mining_rewards)
\ No newline at end of file
@@ -20,6 +20,8 @@ class PositionTracer(SyncerInterface):
     def __init__(self, perpetual_address, inverse, perpetual_position_topic, web3, end_block):
         
         self._perpetual_address = web3.toChecksumAddress(perpetual_address)
+        # the address stored in db
+        self._db_perpetual_address = self._perpetual_address.lower()
         self._inverse = inverse
         self._perpetual_position_topic = perpetual_position_topic
         self._end_block = end_block
@@ -33,7 +35,7 @@ class PositionTracer(SyncerInterface):
         position_event.watcher_id = watcher_id
         position_event.block_number = block_number
         position_event.transaction_hash = transaction_hash
-        position_event.perpetual_address = self._perpetual_address.lower()
+        position_event.perpetual_address = self._db_perpetual_address
         position_event.event_index = event_index
         position_event.holder = holder
         if (self._inverse and side == PositionSide.LONG) or \
@@ -45,12 +47,12 @@ class PositionTracer(SyncerInterface):
         # update position_balances table
         position_balance_item = db_session.query(PositionBalance)\
             .filter(PositionBalance.holder == holder)\
-            .filter(PositionBalance.perpetual_address == self._perpetual_address.lower())\
+            .filter(PositionBalance.perpetual_address == self._db_perpetual_address)\
             .first()
         if position_balance_item is None:
             position_balance_item = PositionBalance()
             position_balance_item.watcher_id = watcher_id
-            position_balance_item.perpetual_address = self._perpetual_address.lower()
+            position_balance_item.perpetual_address = self._db_perpetual_address
             position_balance_item.holder = holder
             position_balance_item.balance = amount
             position_balance_item.block_number = block_number
@@ -84,7 +86,7 @@ class PositionTracer(SyncerInterface):
         self._logger.info(f'rollback position block_number back to {block_number}')
         items = db_session.query(PositionBalance)\
             .filter(PositionBalance.block_number > block_number)\
-            .filter(PositionBalance.perpetual_address == self._perpetual_address.lower())\
+            .filter(PositionBalance.perpetual_address == self._db_perpetual_address)\
             .all()
         for item in items:
             # update position_balances table
@@ -99,9 +101,8 @@ class PositionTracer(SyncerInterface):
             else:
                 item.balance = position_event.amount
                 item.block_number = position_event.block_number
-                db_session.add(item)
         
-        db_session.query(PositionEvent).filter(PositionEvent.perpetual_address == self._perpetual_address.lower()).\
+        db_session.query(PositionEvent).filter(PositionEvent.perpetual_address == self._db_perpetual_address).\
             filter(PositionEvent.block_number > block_number).delete(synchronize_session=False)
 
     ################################ NOTICE ######################################
@@ -1,8 +1,9 @@
+import bisect
 import logging
 import logging.config
-from sqlalchemy import func, desc
+from sqlalchemy import and_, func, text
 from web3 import Web3
-from decimal import Decimal, getcontext, ROUND_DOWN
+from decimal import Decimal, getcontext, localcontext, ROUND_DOWN
 
 from contract.erc20 import ERC20Token
 from lib.address import Address
@@ -15,6 +16,76 @@ import config
 from .types import SyncerInterface
 
 
+WAD = 10 ** 18
+_WAD_DECIMAL = Decimal(WAD)
+
+_DEC_1 = Decimal(1)
+_DEC_0_1 = Decimal('0.1')
+_DEC_0_2 = Decimal('0.2')
+_DEC_0_9 = Decimal('0.9')
+_XIA_A = Decimal('89') / Decimal('80')
+_XIA_B = Decimal('9') / Decimal('8')
+_SHANG_A = Decimal('44') / Decimal('35')
+_SHANG_B = Decimal('9') / Decimal('7')
+# mining round => (full share imbalance rate, min share imbalance rate, min share rate, a, b)
+# effective share between the two imbalance rates is share * (a - imbalance_rate * b)
+_EFFECTIVE_SHARE_PARAMS = {
+    'XIA': (_DEC_0_1, _DEC_0_9, _DEC_0_1, _XIA_A, _XIA_B),
+    'SHANG': (_DEC_0_2, _DEC_0_9, _DEC_0_1, _SHANG_A, _SHANG_B),
+}
+# mining round => blocks adding a pool to the round, in the order _build_pool_layouts unpacks them
+_POOL_FORK_BLOCKS = {
+    'SHANG': (config.SHANG_REWARD_LINK_POOL_BLOCK_NUMBER,),
+    'ZHOU': (config.ZHOU_REWARD_COMP_POOL_BLOCK_NUMBER,
+             config.ZHOU_REWARD_LEND_POOL_BLOCK_NUMBER,
+             config.ZHOU_REWARD_SNX_POOL_BLOCK_NUMBER),
+    'QIN': (config.QIN_REWARD_BTC_POOL_BLOCK_NUMBER,),
+}
+
+_ROLLBACK_IMMATURE_REWARDS_SQL = text("""
+WITH deleted AS (
+    DELETE FROM immature_mining_rewards
+    WHERE block_number > :block_number AND mining_round = :mining_round
+    RETURNING pool_name, holder, mining_round, mcb_balance
+), sums AS (
+    SELECT pool_name, holder, mining_round, SUM(mcb_balance) AS mcb_balance
+    FROM deleted
+    GROUP BY pool_name, holder, mining_round
+)
+UPDATE immature_mining_reward_summaries AS summaries
+SET mcb_balance = summaries.mcb_balance - sums.mcb_balance
+FROM sums
+WHERE summaries.pool_name = sums.pool_name
+    AND summaries.holder = sums.holder
+    AND summaries.mining_round = sums.mining_round
+""")
+
+
+def _to_wei(number):
+    """number as an int with 18 decimals, the reward math in the holder loops runs on these"""
+    if not isinstance(number, Decimal):
+        number = Decimal(str(number))
+    return int(number * WAD)
+
+
+def _from_wei(value):
+    return Decimal(value) / _WAD_DECIMAL
+
+
+def _div_down(x, y):
+    """x / y rounded toward zero, the same as Wad"""
+    q = abs(x) // abs(y)
+    return q if (x < 0) == (y < 0) else -q
+
+
+def _wmul(x, y):
+    return _div_down(x * y, WAD)
+
+
+def _wdiv(x, y):
+    return _div_down(x * WAD, y)
+
+
 class ShareMining(SyncerInterface):
     """Mining according to the balance of the share token.
 
@@ -28,29 +99,114 @@ class ShareMining(SyncerInterface):
         self._mining_round = mining_round
 
         self._eth_perp_share_token_address = config.ETH_PERP_SHARE_TOKEN_ADDRESS.lower()
+        self._link_perp_share_token_address = config.LINK_PERP_SHARE_TOKEN_ADDRESS.lower()
+        self._comp_perp_share_token_address = config.COMP_PERP_SHARE_TOKEN_ADDRESS.lower()
+        self._lend_perp_share_token_address = config.LEND_PERP_SHARE_TOKEN_ADDRESS.lower()
+        self._snx_perp_share_token_address = config.SNX_PERP_SHARE_TOKEN_ADDRESS.lower()
+        self._btc_perp_share_token_address = config.BTC_PERP_SHARE_TOKEN_ADDRESS.lower()
         self._uniswap_mcb_share_token_address = config.UNISWAP_MCB_ETH_SHARE_TOKEN_ADDRESS.lower()
+        self._uniswap_mcb_usdc_share_token_address = config.UNISWAP_MCB_USDC_SHARE_TOKEN_ADDRESS.lower()
         self._mcb_token_address = config.MCB_TOKEN_ADDRESS.lower()
+        self._chainlink_btc_usd_address = config.CHAINLINK_BTC_USD_ADDRESS.lower()
         self._xia_rebalance_hard_fork_block_number = config.XIA_REBALANCE_HARD_FORK_BLOCK_NUMBER
         self._shang_reward_link_pool_block_number = config.SHANG_REWARD_LINK_POOL_BLOCK_NUMBER
         self._shang_reward_btc_pool_block_number = config.SHANG_REWARD_BTC_POOL_BLOCK_NUMBER
         self._zhou_begin_block_number = config.ZHOU_BEGIN_BLOCK_NUMBER
         self._qin_begin_block_number = config.QIN_BEGIN_BLOCK_NUMBER
         self._qin_reduce_reward_block_number = config.QIN_REDUCE_REWARD_BLOCK_NUMBER
+        # sorted fork blocks, and the bucket of the blocks from each of them, the first bucket is before all forks
+        pool_fork_blocks = _POOL_FORK_BLOCKS.get(self._mining_round, ())
+        self._pool_fork_levels = sorted(set(pool_fork_blocks))
+        self._pool_fork_buckets = [tuple(False for _ in pool_fork_blocks)]
+        for level in self._pool_fork_levels:
+            self._pool_fork_buckets.append(tuple(fork_block <= level for fork_block in pool_fork_blocks))
+        # bucket => (pool_info, pool_reward_percent) of each reward pass, shared by every block of the bucket
+        self._pool_layouts = {}
+        for bucket in self._pool_fork_buckets:
+            if bucket not in self._pool_layouts:
+                self._pool_layouts[bucket] = self._build_pool_layouts(bucket)
+        if self._mining_round == 'ZHOU':
+            m = config.ZHOU_M
+            n = config.ZHOU_N
+        elif self._mining_round == 'QIN':
+            m = config.QIN_M
+            n = config.QIN_N
+        else:
+            # default value
+            m = 2
+            n = 102500
+        self._reward_factor_m = Decimal(m)
+        self._reward_factor_n = Decimal(n)
+
+        # share token address => perp/amm/proxy addresses, the map does not change while mining
+        self._token_map_cache = {}
+        # perpetual address => {holder: position balance}, only valid in one sync call
+        self._positions_cache = {}
+        # holder => mcb balance including the mcb in uniswap pool, only valid in one sync call
+        self._mcb_balance_cache = None
+        # token address => non zero balance items and total balance, only valid in one sync call
+        self._token_balances_cache = {}
+        self._token_totals_cache = {}
+        # pool name => {holder: immature summary mcb balance}, holders with a theory reward, only valid in one sync call
+        self._immature_summary_cache = {}
+        self._theory_reward_holders = set()
+        # pool name => chainlink price feed address
+        self._chainlink_price_addresses = {'BTC_PERP': self._chainlink_btc_usd_address}
+        # chainlink address => sorted block numbers and the prices of them, extended by each sync call
+        self._price_blocks = {}
+        self._prices = {}
+        self._price_loaded_block = -1
 
         self._logger = logging.getLogger()
 
-    def _get_token_map(self, share_token_address, db_session):
-        token_map = {}
-        token_map[share_token_address] = {}
-        item = db_session.query(PerpShareAmmProxyMap)\
-            .filter(PerpShareAmmProxyMap.share_addr == share_token_address)\
-            .first()
-        if item is not None:
-            token_map[share_token_address] = {
+    def _preload_token_map(self, share_token_addresses, db_session):
+        addrs = [addr for addr in share_token_addresses if addr not in self._token_map_cache]
+        if len(addrs) == 0:
+            return
+        items = db_session.query(PerpShareAmmProxyMap)\
+            .filter(PerpShareAmmProxyMap.share_addr.in_(addrs))\
+            .with_entities(
+                PerpShareAmmProxyMap.share_addr,
+                PerpShareAmmProxyMap.perp_addr,
+                PerpShareAmmProxyMap.amm_addr,
+                PerpShareAmmProxyMap.proxy_addr
+        ).all()
+        for item in items:
+            self._token_map_cache[item.share_addr] = {
                 'perp_addr': item.perp_addr.strip(),
                 'amm_addr': item.amm_addr.strip(),
                 'amm_proxy_addr': item.proxy_addr.strip(),
             }
+
+    def _preload_position_balances(self, block_number, share_token_addresses, db_session):
+        perp_addrs = []
+        amm_proxy_addrs = []
+        for share_token_address in share_token_addresses:
+            token_map = self._token_map_cache.get(share_token_address, {})
+            perp_addr = token_map.get('perp_addr')
+            if perp_addr is None or perp_addr in self._positions_cache:
+                continue
+            perp_addrs.append(perp_addr)
+            amm_proxy_addrs.append(token_map.get('amm_proxy_addr'))
+            self._positions_cache[perp_addr] = {}
+        if len(perp_addrs) == 0:
+            return
+        query = db_session.query(PositionBalance)\
+            .filter(PositionBalance.perpetual_address.in_(perp_addrs))\
+            .with_entities(
+                PositionBalance.perpetual_address,
+                PositionBalance.holder,
+                PositionBalance.balance
+        )
+        if block_number >= self._zhou_begin_block_number:
+            # from ZHOU only the amm position is used for pool value
+            query = query.filter(PositionBalance.holder.in_(amm_proxy_addrs))
+        for item in query.yield_per(1000):
+            self._positions_cache[item.perpetual_address][item.holder] = item.balance
+
+    def _get_token_map(self, share_token_address, db_session):
+        token_map = {}
+        token_map[share_token_address] = self._token_map_cache.get(share_token_address, {})
         return token_map
 
     def _get_effective_share_info(self, block_number, pool_share_token_address, share_token_items, total_share_token_amount, db_session):
@@ -70,74 +226,90 @@ class ShareMining(SyncerInterface):
         token_map = self._get_token_map(pool_share_token_address, db_session)
         perp_addr = token_map[pool_share_token_address].get('perp_addr')
         amm_proxy_addr = token_map[pool_share_token_address].get('amm_proxy_addr')
-        position_items = db_session.query(PositionBalance)\
-            .filter(PositionBalance.perpetual_address == perp_addr)\
-            .all()
-        for item in position_items:
-            position_holder_dict[item.holder] = item.balance
+        position_holder_dict = self._positions_cache.get(perp_addr, {})
         amm_position = position_holder_dict.get(amm_proxy_addr, Decimal(0))
-
-        for holder, holder_position_in_margin_account in position_holder_dict.items():
-            holder_share_token_amount = share_token_dict.get(holder)
-            if holder_share_token_amount == Decimal(0) or holder_share_token_amount is None:
-                continue
-            holder_position_in_amm = Wad.from_number(amm_position) * Wad.from_number(holder_share_token_amount) / Wad.from_number(total_share_token_amount)
-            holder_portfolio_position = holder_position_in_amm + Wad.from_number(holder_position_in_margin_account)
-            imbalance_rate = abs(holder_portfolio_position / holder_position_in_amm)
-            imbalance_rate = Decimal(str(imbalance_rate))
-            if self._mining_round == 'XIA':
-                if imbalance_rate <= Decimal(0.1):
-                    holder_effective_share = holder_share_token_amount
-                elif imbalance_rate >= Decimal(0.9):
-                    holder_effective_share = holder_share_token_amount * Decimal(0.1)
-                else:
-                    holder_effective_share = holder_share_token_amount * (Decimal(89/80) - imbalance_rate * Decimal(9/8))
-            elif self._mining_round == 'SHANG':
-                if imbalance_rate <= Decimal(0.2):
-                    holder_effective_share = holder_share_token_amount
-                elif imbalance_rate >= Decimal(0.9):
-                    holder_effective_share = holder_share_token_amount * Decimal(0.1)
-                else:
-                    holder_effective_share = holder_share_token_amount * (Decimal(44/35) - imbalance_rate * Decimal(9/7))
+        amm_position_wei = _to_wei(amm_position)
+        total_share_token_wei = _to_wei(total_share_token_amount)
+        full_share_rate, min_share_rate, min_share, a, b = _EFFECTIVE_SHARE_PARAMS[self._mining_round]
+
+        # only holders with both a position and share tokens, share_token_items has no zero balance
+        holders = [holder for holder in position_holder_dict if holder in share_token_dict]
+        for holder in holders:
+            holder_position_in_margin_account = position_holder_dict[holder]
+            holder_share_token_amount = share_token_dict[holder]
+            holder_position_in_amm = _wdiv(_wmul(amm_position_wei, _to_wei(holder_share_token_amount)), total_share_token_wei)
+            holder_portfolio_position = holder_position_in_amm + _to_wei(holder_position_in_margin_account)
+            imbalance_rate = _from_wei(abs(_wdiv(holder_portfolio_position, holder_position_in_amm)))
+            if imbalance_rate <= full_share_rate:
+                holder_effective_share = holder_share_token_amount
+            elif imbalance_rate >= min_share_rate:
+                holder_effective_share = holder_share_token_amount * min_share
+            else:
+                holder_effective_share = holder_share_token_amount * (a - imbalance_rate * b)
             effective_share_dict[holder] = holder_effective_share
             total_effective_share_amount += holder_effective_share
         return effective_share_dict, total_effective_share_amount
 
-    def _get_total_share_token_amount(self, share_token_address, db_session):
-        result = db_session.query(TokenBalance)\
-            .filter(TokenBalance.token == share_token_address)\
+    def _preload_token_balances(self, token_addresses, db_session):
+        addrs = [addr for addr in token_addresses if addr not in self._token_balances_cache]
+        if len(addrs) == 0:
+            return
+        for addr in addrs:
+            self._token_balances_cache[addr] = []
+            self._token_totals_cache[addr] = Decimal(0)
+        items = db_session.query(TokenBalance)\
+            .filter(TokenBalance.token.in_(addrs))\
+            .filter(TokenBalance.balance != 0)\
             .with_entities(
-                func.sum(TokenBalance.balance)
-        ).first()
-        if result[0] is None:
-            total_share_token_amount = 0
-        else:
-            total_share_token_amount = result[0]
-        return total_share_token_amount
+                TokenBalance.token,
+                TokenBalance.holder,
+                TokenBalance.balance
+        ).yield_per(1000)
+        # sum as exactly as the DECIMAL(78, 18) column
+        with localcontext() as ctx:
+            ctx.prec = 78
+            for item in items:
+                self._token_balances_cache[item.token].append(item)
+                self._token_totals_cache[item.token] += item.balance
+
+    def _get_total_share_token_amount(self, share_token_address, db_session):
+        self._preload_token_balances([share_token_address], db_session)
+        return self._token_totals_cache[share_token_address]
 
     def _get_share_token_items(self, share_token_address, db_session):
-        share_token_items = db_session.query(TokenBalance)\
-            .filter(TokenBalance.token == share_token_address)\
-            .filter(TokenBalance.balance != Decimal(0))\
+        self._preload_token_balances([share_token_address], db_session)
+        return self._token_balances_cache[share_token_address]
+
+    def _preload_chain_link_prices(self, block_number, db_session):
+        """append the prices after the last loaded block up to block_number"""
+        if block_number <= self._price_loaded_block:
+            return
+        addrs = list(self._chainlink_price_addresses.values())
+        items = db_session.query(ChainLinkPriceEvent)\
+            .filter(ChainLinkPriceEvent.chain_link_address.in_(addrs))\
+            .filter(ChainLinkPriceEvent.block_number > self._price_loaded_block)\
+            .filter(ChainLinkPriceEvent.block_number <= block_number)\
+            .order_by(ChainLinkPriceEvent.block_number, ChainLinkPriceEvent.event_index)\
             .with_entities(
-                TokenBalance.holder,
-                TokenBalance.balance
+                ChainLinkPriceEvent.chain_link_address,
+                ChainLinkPriceEvent.block_number,
+                ChainLinkPriceEvent.price
         ).all()
-        return share_token_items
+        for item in items:
+            self._price_blocks.setdefault(item.chain_link_address, []).append(item.block_number)
+            self._prices.setdefault(item.chain_link_address, []).append(item.price)
+        self._price_loaded_block = block_number
 
     def _get_chain_link_price(self, block_number, pool_name, db_session):
-        if pool_name == 'BTC_PERP':
-            link_price_address = config.CHAINLINK_BTC_USD_ADDRESS.lower()
-        link_price_item = db_session.query(ChainLinkPriceEvent)\
-            .filter(ChainLinkPriceEvent.chain_link_address == link_price_address)\
-            .filter(ChainLinkPriceEvent.block_number <= block_number)\
-            .order_by(desc(ChainLinkPriceEvent.block_number))\
-            .first()
-        if link_price_item is None:
+        link_price_address = self._chainlink_price_addresses.get(pool_name)
+        if link_price_address is None:
+            raise Exception(f'no chainlink price of pool {pool_name}!')
+        self._preload_chain_link_prices(block_number, db_session)
+        price_blocks = self._price_blocks.get(link_price_address, [])
+        i = bisect.bisect_right(price_blocks, block_number)
+        if i == 0:
             raise Exception('link price still not sync!')
-        else:
-            price = link_price_item.price
-            return price
+        return self._prices[link_price_address][i-1]
 
     def _get_pool_usd_value(self, block_number, pool_name, pool_share_token_address, inverse, db_session):
         amm_usd_value = Decimal(0)
@@ -145,12 +317,7 @@ class ShareMining(SyncerInterface):
         token_map = self._get_token_map(pool_share_token_address, db_session)
         perp_addr = token_map[pool_share_token_address].get('perp_addr')
         amm_proxy_addr = token_map[pool_share_token_address].get('amm_proxy_addr')
-        amm_proxy_item = db_session.query(PositionBalance)\
-            .filter(PositionBalance.perpetual_address == perp_addr)\
-            .filter(PositionBalance.holder == amm_proxy_addr)\
-            .first()
-        if amm_proxy_item:
-            amm_position = amm_proxy_item.balance
+        amm_position = self._positions_cache.get(perp_addr, {}).get(amm_proxy_addr, Decimal(0))
         if inverse:
             amm_usd_value = abs(Wad.from_number(amm_position))
         else:
@@ -168,13 +335,14 @@ class ShareMining(SyncerInterface):
         elif  block_number >= 11601000 and block_number < 11685000:
             self._reward_per_block = 0.1875
         # update uniswap_pool_proportion, every block update
-        self._update_uniswap_pool_proportion(pool_info, db_session)
+        uniswap_pool_proportions = self._get_uniswap_pool_proportions(pool_info, db_session)
         
         pool_value_info = {}
         pools_total_effective_value = Wad(0)
+        pools_block_reward = Wad.from_number(pool_reward_percent) * Wad.from_number(self._reward_per_block)
         for pool_name in pool_info.keys():
             pool_share_token_address = pool_info[pool_name].get('pool_share_token_address')
-            if pool_name not in pool_value_info.keys():
+            if pool_name not in pool_value_info:
                 pool_value_info[pool_name] = {}
             pool_value_info[pool_name]['pool_share_token_address'] = pool_share_token_address
             
@@ -183,7 +351,7 @@ class ShareMining(SyncerInterface):
             pool_value_info[pool_name]['amm_pool_proportion'] = amm_pool_proportion
 
             # use for uniswap pools reward distribute 
-            uniswap_pool_proportion = pool_info[pool_name].get('uniswap_pool_proportion', 1)
+            uniswap_pool_proportion = uniswap_pool_proportions.get(pool_name, 1)
             pool_value_info[pool_name]['uniswap_pool_proportion'] = uniswap_pool_proportion
 
             pool_type = pool_info[pool_name].get('pool_type')
@@ -216,23 +384,26 @@ class ShareMining(SyncerInterface):
                 # include two case: 
                 # 1) pool_type is UNISWAP;
                 # 2) pool_type is AMM and block number before _xia_rebalance_hard_fork_block_number;
-                pool_reward = Wad.from_number(pool_reward_percent) * Wad.from_number(self._reward_per_block) * Wad.from_number(uniswap_pool_proportion)
+                pool_reward = pools_block_reward * Wad.from_number(uniswap_pool_proportion)
                 pool_value_info[pool_name]['pool_reward'] = pool_reward
         
         # update AMM pool reward
         if pool_type == 'AMM' and block_number >= self._xia_rebalance_hard_fork_block_number:
+            pools_total_effective_wad = Wad.from_number(pools_total_effective_value)
             for pool_name in pool_value_info.keys():
                 amm_pool_proportion = pool_value_info[pool_name].get('amm_pool_proportion', 1)
                 pool_effective_usd_value = pool_value_info[pool_name]['pool_effective_usd_value']
                 if block_number >= self._qin_begin_block_number:
-                    pool_reward = Wad.from_number(pool_reward_percent) * Wad.from_number(self._reward_per_block) * Wad.from_number(amm_pool_proportion)
+                    pool_reward = pools_block_reward * Wad.from_number(amm_pool_proportion)
                 else:
-                    pool_reward = Wad.from_number(pool_reward_percent) * Wad.from_number(self._reward_per_block) * pool_effective_usd_value / Wad.from_number(pools_total_effective_value)
+                    pool_reward = pools_block_reward * pool_effective_usd_value / pools_total_effective_wad
                 pool_value_info[pool_name]['pool_reward'] = pool_reward
 
         return pool_value_info
 
     def _get_holder_mcb_balance(self, db_session):
+        if self._mcb_balance_cache is not None:
+            return self._mcb_balance_cache
         holder_mcb_balance_dict = {}
         mcb_token_items = self._get_share_token_items(self._mcb_token_address, db_session)
         for item in mcb_token_items:
@@ -245,182 +416,222 @@ class ShareMining(SyncerInterface):
             for item in uniswap_share_items:
                 holder = item.holder
                 holder_mcb_amount = uniswap_pool_total_mcb_balance * item.balance / uniswap_total_share_token_amount
-                if holder not in holder_mcb_balance_dict.keys():
+                holder_mcb_balance = holder_mcb_balance_dict.get(holder)
+                if holder_mcb_balance is None:
                     holder_mcb_balance_dict[holder] = holder_mcb_amount
                 else:
-                    holder_mcb_balance_dict[holder] += holder_mcb_amount
+                    holder_mcb_balance_dict[holder] = holder_mcb_balance + holder_mcb_amount
+        self._mcb_balance_cache = holder_mcb_balance_dict
         return holder_mcb_balance_dict
 
     def _get_holder_reward_factor(self, holder, reward, holder_mcb_balance):
-        if self._mining_round == 'ZHOU':
-            m = config.ZHOU_M
-            n = config.ZHOU_N
-        if self._mining_round == 'QIN':
-            m = config.QIN_M
-            n = config.QIN_N
-        else:
-            # default value
-            m = 2
-            n = 102500
-        M = Decimal(m)
-        N = Decimal(n)
-        
-        if reward == Decimal(0):
-            mcb_weight = Decimal(0)
-        else:
-            mcb_weight = holder_mcb_balance / (reward * N)
-        if mcb_weight < 1:
-            reward_factor = Decimal(1) + mcb_weight * M
-        else:
-            reward_factor = Decimal(1) + M
-        return reward_factor
+        if reward == 0:
+            return _DEC_1
+        mcb_weight = holder_mcb_balance / (reward * self._reward_factor_n)
+        return _DEC_1 + min(mcb_weight, _DEC_1) * self._reward_factor_m
+
+    def _preload_reward_tables(self, block_number, db_session):
+        self._immature_summary_cache = {}
+        immature_summary_items = db_session.query(ImmatureMiningRewardSummary)\
+            .filter(ImmatureMiningRewardSummary.mining_round == self._mining_round)\
+            .with_entities(
+                ImmatureMiningRewardSummary.pool_name,
+                ImmatureMiningRewardSummary.holder,
+                ImmatureMiningRewardSummary.mcb_balance
+        ).yield_per(1000)
+        for item in immature_summary_items:
+            if item.pool_name not in self._immature_summary_cache:
+                self._immature_summary_cache[item.pool_name] = {}
+            self._immature_summary_cache[item.pool_name][item.holder] = item.mcb_balance
+
+        self._theory_reward_holders = set()
+        if block_number >= self._zhou_begin_block_number:
+            # theory mining reward from period ZHOU
+            theory_mining_reward_items = db_session.query(TheoryMiningReward)\
+                .filter(TheoryMiningReward.mining_round == self._mining_round)\
+                .with_entities(TheoryMiningReward.holder)\
+                .yield_per(1000)
+            for item in theory_mining_reward_items:
+                self._theory_reward_holders.add(item.holder)
 
     def _save_theory_mining_reward(self, pool_type, holder_amms_reward_dict, db_session):
-        theory_mining_reward_dict = {}
-        theory_mining_reward_items = db_session.query(TheoryMiningReward)\
-            .filter(TheoryMiningReward.mining_round == self._mining_round)\
-            .all()
-        for item in theory_mining_reward_items:
-            theory_mining_reward_dict[item.holder] = item
-        
+        new_rewards = []
+        updated_rewards = []
         for holder, reward in holder_amms_reward_dict.items():
-            if holder not in theory_mining_reward_dict.keys():
-                theory_mining_reward_item = TheoryMiningReward()
-                theory_mining_reward_item.mining_round = self._mining_round
-                theory_mining_reward_item.pool_type = pool_type
-                theory_mining_reward_item.holder = holder
-                theory_mining_reward_item.mcb_balance = reward
+            theory_mining_reward = {
+                'mining_round': self._mining_round,
+                'pool_type': pool_type,
+                'holder': holder,
+                'mcb_balance': reward,
+            }
+            if holder not in self._theory_reward_holders:
+                new_rewards.append(theory_mining_reward)
+                self._theory_reward_holders.add(holder)
             else:
-                theory_mining_reward_item = theory_mining_reward_dict[holder]
-                theory_mining_reward_item.mcb_balance = reward
-            db_session.add(theory_mining_reward_item)
-
-    def _get_holder_reward_weight(self, block_number, pool_value_info, db_session):
-        holder_amms_weight_dict = {}
+                updated_rewards.append(theory_mining_reward)
+        db_session.bulk_insert_mappings(TheoryMiningReward, new_rewards)
+        db_session.bulk_update_mappings(TheoryMiningReward, updated_rewards)
+
+    def _get_holder_pools_reward(self, block_number, pool_value_info):
+        """rewards of the holders in every pool before weighting
+
+        Returns:
+            holder_pools_reward: pool name => {holder: reward}
+            holder_pools_reward_wei: pool name => {holder: reward in wei}
+            holder_amms_reward_dict: holder => reward of all pools
+            amms_pool_total_reward: reward of all pools
+        """
+        holder_pools_reward = {}
+        holder_pools_reward_wei = {}
         holder_amms_reward_dict = {}
-        amms_pool_total_reward = Decimal(0)
-
+        amms_pool_total_reward_wei = 0
         for pool_name in pool_value_info.keys():
             total_share_token_amount = pool_value_info[pool_name]['total_share_token_amount']
             if total_share_token_amount == 0:
                 continue
             share_token_items = pool_value_info[pool_name]['share_token_items']
             pool_type = pool_value_info[pool_name]['pool_type']
-            pool_reward = pool_value_info[pool_name]['pool_reward']
-            amms_pool_total_reward += Decimal(str(pool_reward))
+            pool_reward_wei = pool_value_info[pool_name]['pool_reward'].value
+            amms_pool_total_reward_wei += pool_reward_wei
+            use_effective_share = pool_type == 'AMM' and block_number >= self._xia_rebalance_hard_fork_block_number
+            if use_effective_share:
+                effective_share_dict = pool_value_info[pool_name]['effective_share_dict']
+                total_effective_share_wei = _to_wei(pool_value_info[pool_name]['total_effective_share_amount'])
 
+            holder_reward_dict = {}
+            pool_reward_wei_dict = {}
             for item in share_token_items:
                 holder = item.holder
-                if item.balance == Decimal(0):
-                    continue
                 # amm pool, use effective share after xia_rebalance_hard_fork block number
-                if pool_type == 'AMM' and block_number >= self._xia_rebalance_hard_fork_block_number:
-                    total_effective_share_amount = pool_value_info[pool_name]['total_effective_share_amount']
-                    holder_effective_share_amount = pool_value_info[pool_name]['effective_share_dict'].get(holder, Decimal(0))
-                    wad_reward = pool_reward * Wad.from_number(holder_effective_share_amount) / Wad.from_number(total_effective_share_amount)
-                    reward = Decimal(str(wad_reward))
-                    if holder not in holder_amms_reward_dict:
+                if use_effective_share:
+                    holder_effective_share_wei = _to_wei(effective_share_dict.get(holder, Decimal(0)))
+                    reward_wei = _wdiv(_wmul(pool_reward_wei, holder_effective_share_wei), total_effective_share_wei)
+                    pool_reward_wei_dict[holder] = reward_wei
+                    reward = _from_wei(reward_wei)
+                    holder_reward_dict[holder] = reward
+                    holder_amms_reward = holder_amms_reward_dict.get(holder)
+                    if holder_amms_reward is None:
                         holder_amms_reward_dict[holder] = reward
                     else:
-                        holder_amms_reward_dict[holder] += reward
-        
+                        holder_amms_reward_dict[holder] = holder_amms_reward + reward
+            holder_pools_reward[pool_name] = holder_reward_dict
+            holder_pools_reward_wei[pool_name] = pool_reward_wei_dict
+        amms_pool_total_reward = _from_wei(amms_pool_total_reward_wei)
+        return holder_pools_reward, holder_pools_reward_wei, holder_amms_reward_dict, amms_pool_total_reward
+
+    def _get_holder_reward_weight(self, block_number, pool_value_info, db_session):
+        """
+        Returns:
+            holder_amms_weight_dict: holder => reward weight
+            holder_pools_reward_wei: pool name => {holder: reward in wei before weighting}
+        """
+        holder_amms_weight_dict = {}
+        _, holder_pools_reward_wei, holder_amms_reward_dict, amms_pool_total_reward = \
+            self._get_holder_pools_reward(block_number, pool_value_info)
+
         self._save_theory_mining_reward('AMM', holder_amms_reward_dict, db_session)
 
         holder_mcb_balance_dict = self._get_holder_mcb_balance(db_session)
-        total_holder_reward_weight = Decimal(0)
+        holder_factor_dict = {}
+        # sum of reward_percent * factor, divided by the total reward once after the loop
+        total_holder_weighted_reward = Decimal(0)
         for holder, reward in holder_amms_reward_dict.items():
-            holder_reward_percent = reward / amms_pool_total_reward
             holder_mcb_balance = holder_mcb_balance_dict.get(holder, Decimal(0))
             reward_factor = self._get_holder_reward_factor(holder, reward, holder_mcb_balance)
-            total_holder_reward_weight += holder_reward_percent * reward_factor
+            holder_factor_dict[holder] = reward_factor
+            total_holder_weighted_reward += reward * reward_factor
+        if len(holder_factor_dict) == 0:
+            return holder_amms_weight_dict, holder_pools_reward_wei
+        total_holder_reward_weight = total_holder_weighted_reward / amms_pool_total_reward
 
-        for holder, reward in holder_amms_reward_dict.items():
-            holder_mcb_balance = holder_mcb_balance_dict.get(holder, Decimal(0))
-            reward_factor = self._get_holder_reward_factor(holder, reward, holder_mcb_balance)
+        for holder, reward_factor in holder_factor_dict.items():
             holder_amms_weight_dict[holder] = reward_factor / total_holder_reward_weight
 
-        return holder_amms_weight_dict
+        return holder_amms_weight_dict, holder_pools_reward_wei
 
     def _get_holder_amms_reward_weight(self, block_number, pool_value_info, db_session):
+        """
+        Returns:
+            holder_amms_weight_dict: pool name => {holder: reward weight in the pool}
+            holder_pools_reward_wei: pool name => {holder: reward in wei before weighting}
+        """
         holder_amms_weight_dict = {}
-        holder_amms_reward_dict = {}
-        holder_pools_reward = {}
-        for pool_name in pool_value_info.keys():
-            # calc holder in every pool weight
-            holder_reward_dict = {}
-            total_share_token_amount = pool_value_info[pool_name]['total_share_token_amount']
-            if total_share_token_amount == 0:
-                continue
-            share_token_items = pool_value_info[pool_name]['share_token_items']
-            pool_type = pool_value_info[pool_name]['pool_type']
-            pool_reward = pool_value_info[pool_name]['pool_reward']
-
-            for item in share_token_items:
-                holder = item.holder
-                if item.balance == Decimal(0):
-                    continue
-                # amm pool, use effective share after xia_rebalance_hard_fork block number
-                if pool_type == 'AMM' and block_number >= self._xia_rebalance_hard_fork_block_number:
-                    total_effective_share_amount = pool_value_info[pool_name]['total_effective_share_amount']
-                    holder_effective_share_amount = pool_value_info[pool_name]['effective_share_dict'].get(holder, Decimal(0))
-                    wad_reward = pool_reward * Wad.from_number(holder_effective_share_amount) / Wad.from_number(total_effective_share_amount)
-                    reward = Decimal(str(wad_reward))
-                    holder_reward_dict[holder] = reward
-                    if holder not in holder_amms_reward_dict:
-                        holder_amms_reward_dict[holder] = reward
-                    else:
-                        holder_amms_reward_dict[holder] += reward
-            holder_pools_reward[pool_name] = holder_reward_dict
+        holder_pools_reward, holder_pools_reward_wei, holder_amms_reward_dict, _ = \
+            self._get_holder_pools_reward(block_number, pool_value_info)
 
         self._save_theory_mining_reward('AMM', holder_amms_reward_dict, db_session)
 
+        # the factor only depends on the holder's reward of all pools, the same in every pool
         holder_mcb_balance_dict = self._get_holder_mcb_balance(db_session)
+        holder_factor_dict = {}
+        for holder, holder_total_pool_reward in holder_amms_reward_dict.items():
+            holder_mcb_balance = holder_mcb_balance_dict.get(holder, Decimal(0))
+            holder_factor_dict[holder] = self._get_holder_reward_factor(holder, holder_total_pool_reward, holder_mcb_balance)
+
         for pool_name in pool_value_info.keys():
             # calc holder in every pool weight
             holder_weight_dict = {}
-            holder_reward_dict = {}
-            pool_reward = pool_value_info[pool_name]['pool_reward']
+            pool_reward = _from_wei(pool_value_info[pool_name]['pool_reward'].value)
 
-            holder_total_pool_reward_weight = Decimal(0)
+            holder_total_pool_weighted_reward = Decimal(0)
             for holder, holder_pool_reward in holder_pools_reward[pool_name].items():
-                holder_reward_percent = holder_pool_reward / Decimal(str(pool_reward))
-                holder_total_pool_reward = holder_amms_reward_dict.get(holder)
-                holder_mcb_balance = holder_mcb_balance_dict.get(holder, Decimal(0))
-                reward_factor = self._get_holder_reward_factor(holder, holder_total_pool_reward, holder_mcb_balance)
-                holder_total_pool_reward_weight += holder_reward_percent * reward_factor
-
-            for holder, holder_pool_reward in holder_pools_reward[pool_name].items():                
-                holder_mcb_balance = holder_mcb_balance_dict.get(holder, Decimal(0))
-                holder_total_pool_reward = holder_amms_reward_dict.get(holder)
-                reward_factor = self._get_holder_reward_factor(holder, holder_total_pool_reward, holder_mcb_balance)
-                holder_weight_dict[holder] = reward_factor / holder_total_pool_reward_weight
-            holder_amms_weight_dict[pool_name] = holder_weight_dict
+                holder_total_pool_weighted_reward += holder_pool_reward * holder_factor_dict[holder]
+            if len(holder_pools_reward[pool_name]) > 0:
+                holder_total_pool_reward_weight = holder_total_pool_weighted_reward / pool_reward
 
-        return holder_amms_weight_dict
+            for holder in holder_pools_reward[pool_name]:
+                holder_weight_dict[holder] = holder_factor_dict[holder] / holder_total_pool_reward_weight
+            holder_amms_weight_dict[pool_name] = holder_weight_dict
 
-    def _calculate_pools_reward(self, block_number, pool_info, pool_reward_percent, db_session):
+        return holder_amms_weight_dict, holder_pools_reward_wei
+
+    def _calculate_pools_reward(self, block_number, pool_layouts, db_session):
+        """calculate the rewards of every (pool_info, pool_reward_percent) pass and save them together"""
+        share_token_addresses = []
+        amm_share_token_addresses = []
+        for pool_info, _ in pool_layouts:
+            for info in pool_info.values():
+                share_token_addresses.append(info['pool_share_token_address'])
+                if info['pool_type'] == 'AMM':
+                    amm_share_token_addresses.append(info['pool_share_token_address'])
+        self._preload_token_map(share_token_addresses, db_session)
+        self._preload_token_balances(share_token_addresses + [self._mcb_token_address, self._uniswap_mcb_share_token_address], db_session)
+        if block_number >= self._xia_rebalance_hard_fork_block_number:
+            self._preload_position_balances(block_number, amm_share_token_addresses, db_session)
+
+        immature_mining_rewards = []
+        new_immature_summaries = []
+        updated_immature_summaries = []
+        for pool_info, pool_reward_percent in pool_layouts:
+            self._append_pools_reward(block_number, pool_info, pool_reward_percent,
+                                      immature_mining_rewards, new_immature_summaries, updated_immature_summaries, db_session)
+        db_session.bulk_insert_mappings(ImmatureMiningReward, immature_mining_rewards)
+        db_session.bulk_insert_mappings(ImmatureMiningRewardSummary, new_immature_summaries)
+        db_session.bulk_update_mappings(ImmatureMiningRewardSummary, updated_immature_summaries)
+
+    def _append_pools_reward(self, block_number, pool_info, pool_reward_percent,
+                             immature_mining_rewards, new_immature_summaries, updated_immature_summaries, db_session):
+        """append the reward and summary mappings of the pools in pool_info to the lists"""
         pool_value_info = self._get_pool_value_info(block_number, pool_info, pool_reward_percent, db_session)
         self._logger.info(f'sync mining reward, block_number:{block_number}, pools:{",".join(pool_info.keys())}')
         
         holder_amms_weight_dict = {}
         holder_weight_dict = {}
+        # rewards before weighting are computed by the weight helpers, reuse them
+        holder_pools_reward_wei = {}
         if block_number >= self._qin_begin_block_number:
-            holder_amms_weight_dict = self._get_holder_amms_reward_weight(block_number, pool_value_info, db_session)
+            holder_amms_weight_dict, holder_pools_reward_wei = self._get_holder_amms_reward_weight(block_number, pool_value_info, db_session)
         elif block_number >= self._zhou_begin_block_number:
-            holder_weight_dict = self._get_holder_reward_weight(block_number, pool_value_info, db_session)
+            holder_weight_dict, holder_pools_reward_wei = self._get_holder_reward_weight(block_number, pool_value_info, db_session)
 
         for pool_name in pool_value_info.keys():
             if block_number >= self._qin_begin_block_number:
                 holder_weight_dict = holder_amms_weight_dict.get(pool_name, {})
 
             # get all immature summary items of pool_name
-            immature_summary_dict = {}
-            immature_summary_items = db_session.query(ImmatureMiningRewardSummary)\
-                .filter(ImmatureMiningRewardSummary.mining_round == self._mining_round)\
-                .filter(ImmatureMiningRewardSummary.pool_name == pool_name)\
-                .all()
-            for item in immature_summary_items:
-                immature_summary_dict[item.holder] = item    
+            if pool_name not in self._immature_summary_cache:
+                self._immature_summary_cache[pool_name] = {}
+            immature_summary_dict = self._immature_summary_cache[pool_name]
 
             total_share_token_amount = pool_value_info[pool_name]['total_share_token_amount']
             if total_share_token_amount == 0:
@@ -429,45 +640,53 @@ class ShareMining(SyncerInterface):
 
             share_token_items = pool_value_info[pool_name]['share_token_items']
             pool_type = pool_value_info[pool_name]['pool_type']
-            pool_reward = pool_value_info[pool_name]['pool_reward']
+            pool_reward_wei = pool_value_info[pool_name]['pool_reward'].value
+            total_share_token_wei = _to_wei(total_share_token_amount)
+            use_effective_share = pool_type == 'AMM' and block_number >= self._xia_rebalance_hard_fork_block_number
+            if use_effective_share:
+                effective_share_dict = pool_value_info[pool_name]['effective_share_dict']
+                total_effective_share_wei = _to_wei(pool_value_info[pool_name]['total_effective_share_amount'])
+            pool_reward_wei_dict = holder_pools_reward_wei.get(pool_name)
 
             for item in share_token_items:
                 holder = item.holder
-                if item.balance == Decimal(0):
-                    continue
                 # amm pool, use effective share after xia_rebalance_hard_fork block number
-                if pool_type == 'AMM' and block_number >= self._xia_rebalance_hard_fork_block_number:
-                    holder_weight = holder_weight_dict.get(holder, Decimal(1))
-                    total_effective_share_amount = pool_value_info[pool_name]['total_effective_share_amount']
-                    holder_effective_share_amount = pool_value_info[pool_name]['effective_share_dict'].get(holder, Decimal(0))
-                    wad_reward = Wad.from_number(holder_weight) * pool_reward * Wad.from_number(holder_effective_share_amount) / Wad.from_number(total_effective_share_amount)
-                    reward = Decimal(str(wad_reward))
+                if use_effective_share:
+                    if pool_reward_wei_dict is not None:
+                        holder_weight = holder_weight_dict.get(holder, Decimal(1))
+                        reward = _from_wei(_wmul(_to_wei(holder_weight), pool_reward_wei_dict[holder]))
+                    else:
+                        holder_effective_share_wei = _to_wei(effective_share_dict.get(holder, Decimal(0)))
+                        reward = _from_wei(_wdiv(_wmul(pool_reward_wei, holder_effective_share_wei), total_effective_share_wei))
                 else:
-                    holder_share_token_amount = Decimal(item.balance)
-                    wad_reward = pool_reward * Wad.from_number(holder_share_token_amount) / Wad.from_number(total_share_token_amount)
-                    reward = Decimal(str(wad_reward))
-
-                immature_mining_reward = ImmatureMiningReward()
-                immature_mining_reward.block_number = block_number
-                immature_mining_reward.pool_name = pool_name
-                immature_mining_reward.mining_round = self._mining_round
-                immature_mining_reward.holder = holder
-                immature_mining_reward.mcb_balance = reward
-                db_session.add(immature_mining_reward)
+                    holder_share_token_wei = _to_wei(item.balance)
+                    reward = _from_wei(_wdiv(_wmul(pool_reward_wei, holder_share_token_wei), total_share_token_wei))
+
+                immature_mining_rewards.append({
+                    'block_number': block_number,
+                    'pool_name': pool_name,
+                    'mining_round': self._mining_round,
+                    'holder': holder,
+                    'mcb_balance': reward,
+                })
 
                 # update immature_mining_reward_summaries table, simulated materialized view
-                if holder not in immature_summary_dict.keys():
-                    immature_summary_item = ImmatureMiningRewardSummary()
-                    immature_summary_item.mining_round = self._mining_round
-                    immature_summary_item.pool_name = pool_name
-                    immature_summary_item.holder = holder
-                    immature_summary_item.mcb_balance = reward
+                if holder not in immature_summary_dict:
+                    summary_balance = reward
+                    summaries = new_immature_summaries
                 else:
-                    immature_summary_item = immature_summary_dict[holder]
-                    immature_summary_item.mcb_balance += reward
-                db_session.add(immature_summary_item)
-
-    def _update_uniswap_pool_proportion(self, pool_info, db_session):
+                    summary_balance = immature_summary_dict[holder] + reward
+                    summaries = updated_immature_summaries
+                immature_summary_dict[holder] = summary_balance
+                summaries.append({
+                    'mining_round': self._mining_round,
+                    'pool_name': pool_name,
+                    'holder': holder,
+                    'mcb_balance': summary_balance,
+                })
+
+    def _get_uniswap_pool_proportions(self, pool_info, db_session):
+        uniswap_pool_proportions = {}
         holder_mcb_balance_dict = self._get_holder_mcb_balance(db_session)
         total_mcb_balance_in_uniswap_pools = Decimal(0)
         for pool_name in pool_info.keys():
@@ -483,7 +702,8 @@ class ShareMining(SyncerInterface):
                 pool_share_token_address = pool_info[pool_name].get('pool_share_token_address')
                 holder_mcb_balance = holder_mcb_balance_dict.get(pool_share_token_address, Decimal(0))
                 uniswap_pool_proportion = holder_mcb_balance / total_mcb_balance_in_uniswap_pools
-                pool_info[pool_name]['uniswap_pool_proportion'] = uniswap_pool_proportion
+                uniswap_pool_proportions[pool_name] = uniswap_pool_proportion
+        return uniswap_pool_proportions
 
     def sync(self, watcher_id, block_number, block_hash, db_session):
         """Sync data"""
@@ -491,84 +711,104 @@ class ShareMining(SyncerInterface):
             self._logger.info(f'reward of mining_round: {self._mining_round}, block_number {block_number} not in mining window!')
             return
 
+        self._positions_cache = {}
+        self._mcb_balance_cache = None
+        self._token_balances_cache = {}
+        self._token_totals_cache = {}
+        self._preload_reward_tables(block_number, db_session)
+        # prices from block_number on may come from an aborted transaction, read them again
+        self._rollback_chain_link_prices(block_number - 1)
+        bucket = self._pool_fork_buckets[bisect.bisect_right(self._pool_fork_levels, block_number)]
+        self._calculate_pools_reward(block_number, self._pool_layouts[bucket], db_session)
+
+    def _build_pool_layouts(self, bucket):
+        """(pool_info, pool_reward_percent) of each reward pass of the mining round
+
+        bucket holds whether each block of _POOL_FORK_BLOCKS[self._mining_round] is reached.
+        The layouts are built once in __init__ and shared by every block, they must not be modified.
+        """
+        layouts = []
         if self._mining_round == 'XIA': 
             pool_info = {}
-            pool_info['ETH_PERP'] = {'pool_share_token_address': config.ETH_PERP_SHARE_TOKEN_ADDRESS.lower(), 
+            pool_info['ETH_PERP'] = {'pool_share_token_address': self._eth_perp_share_token_address, 
                                      'pool_type': 'AMM',
                                      'pool_contract_inverse': True}
             amms_total_reward_percent = 1
             pool_reward_percent = amms_total_reward_percent  
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
         elif self._mining_round == 'SHANG':            
             # AMM pools
             pool_info = {}
-            pool_info['ETH_PERP'] = {'pool_share_token_address': config.ETH_PERP_SHARE_TOKEN_ADDRESS.lower(), 
+            pool_info['ETH_PERP'] = {'pool_share_token_address': self._eth_perp_share_token_address, 
                                      'pool_type': 'AMM',
                                      'pool_contract_inverse': True}
-            if block_number >= self._shang_reward_link_pool_block_number:
+            reach_link_pool_block = bucket[0]
+            if reach_link_pool_block:
                 # add amm link pool reward
-                pool_info['LINK_PERP'] =  {'pool_share_token_address': config.LINK_PERP_SHARE_TOKEN_ADDRESS.lower(),
+                pool_info['LINK_PERP'] =  {'pool_share_token_address': self._link_perp_share_token_address,
                             'pool_type': 'AMM',
                             'pool_contract_inverse': True}
             amms_total_reward_percent = 0.75
             pool_reward_percent = amms_total_reward_percent            
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
 
             # UNISWAP pool
             pool_info = {}
-            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': config.UNISWAP_MCB_ETH_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': self._uniswap_mcb_share_token_address,
                                             'pool_type': 'UNISWAP'}              
             uniswap_mcb_reward_percent = 0.25
             pool_reward_percent = uniswap_mcb_reward_percent
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
         elif self._mining_round == 'ZHOU':
             # AMM pools
             pool_info = {}
-            pool_info['ETH_PERP'] = {'pool_share_token_address': config.ETH_PERP_SHARE_TOKEN_ADDRESS.lower(), 
+            pool_info['ETH_PERP'] = {'pool_share_token_address': self._eth_perp_share_token_address, 
                                      'pool_type': 'AMM',
                                      'pool_contract_inverse': True}
-            pool_info['LINK_PERP'] =  {'pool_share_token_address': config.LINK_PERP_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['LINK_PERP'] =  {'pool_share_token_address': self._link_perp_share_token_address,
                         'pool_type': 'AMM',
                         'pool_contract_inverse': True}            
-            if block_number >= config.ZHOU_REWARD_COMP_POOL_BLOCK_NUMBER:
+            reach_comp_pool_block, reach_lend_pool_block, reach_snx_pool_block = bucket
+            if reach_comp_pool_block:
                 # add amm comp pool reward
-                pool_info['COMP_PERP'] = {'pool_share_token_address': config.COMP_PERP_SHARE_TOKEN_ADDRESS.lower(),
+                pool_info['COMP_PERP'] = {'pool_share_token_address': self._comp_perp_share_token_address,
                                             'pool_type': 'AMM',
                                             'pool_contract_inverse': True}
 
-            if block_number >= config.ZHOU_REWARD_LEND_POOL_BLOCK_NUMBER:
+            if reach_lend_pool_block:
                 # add amm lend pool reward
-                pool_info['LEND_PERP'] = {'pool_share_token_address': config.LEND_PERP_SHARE_TOKEN_ADDRESS.lower(),
+                pool_info['LEND_PERP'] = {'pool_share_token_address': self._lend_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': True}
 
-            if block_number >= config.ZHOU_REWARD_SNX_POOL_BLOCK_NUMBER:
+            if reach_snx_pool_block:
                 # add amm snx pool reward
-                pool_info['SNX_PERP'] = {'pool_share_token_address': config.SNX_PERP_SHARE_TOKEN_ADDRESS.lower(),
+                pool_info['SNX_PERP'] = {'pool_share_token_address': self._snx_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': True}
 
             amms_total_reward_percent = 0.75
             pool_reward_percent = amms_total_reward_percent            
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
 
             # UNISWAP pool
             pool_info = {}
-            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': config.UNISWAP_MCB_ETH_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': self._uniswap_mcb_share_token_address,
                                             'pool_type': 'UNISWAP'}            
             uniswap_mcb_reward_percent = 0.25
             pool_reward_percent = uniswap_mcb_reward_percent
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
         elif self._mining_round == 'QIN':
             # AMM pools
             pool_info = {}
             eth_pool_proportion = 0.8
-            pool_info['ETH_PERP'] = {'pool_share_token_address': config.ETH_PERP_SHARE_TOKEN_ADDRESS.lower(), 
+            pool_info['ETH_PERP'] = {'pool_share_token_address': self._eth_perp_share_token_address, 
                                      'pool_type': 'AMM',
                                      'pool_contract_inverse': True,
                                      'amm_pool_proportion': eth_pool_proportion}
 
-            if block_number >= config.QIN_REWARD_BTC_POOL_BLOCK_NUMBER:
+            reach_btc_pool_block = bucket[0]
+            if reach_btc_pool_block:
                 # LINK, COMP, LEND, SNX, BTC
                 little_pool_num = 5
             else:
@@ -576,80 +816,98 @@ class ShareMining(SyncerInterface):
                 little_pool_num = 4
             little_pools_mean_proportion = 0.2 / little_pool_num
 
-            pool_info['LINK_PERP'] =  {'pool_share_token_address': config.LINK_PERP_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['LINK_PERP'] =  {'pool_share_token_address': self._link_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': True,
                                         'amm_pool_proportion': little_pools_mean_proportion}
             # add amm comp pool reward
-            pool_info['COMP_PERP'] = {'pool_share_token_address': config.COMP_PERP_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['COMP_PERP'] = {'pool_share_token_address': self._comp_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': True,            
                                         'amm_pool_proportion': little_pools_mean_proportion}
             # add amm lend pool reward
-            pool_info['LEND_PERP'] = {'pool_share_token_address': config.LEND_PERP_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['LEND_PERP'] = {'pool_share_token_address': self._lend_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': True,            
                                         'amm_pool_proportion': little_pools_mean_proportion}
             # add amm snx pool reward
-            pool_info['SNX_PERP'] = {'pool_share_token_address': config.SNX_PERP_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['SNX_PERP'] = {'pool_share_token_address': self._snx_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': True,            
                                         'amm_pool_proportion': little_pools_mean_proportion}
-            if block_number >= config.QIN_REWARD_BTC_POOL_BLOCK_NUMBER:
+            if reach_btc_pool_block:
                 # add amm btc pool reward
-                pool_info['BTC_PERP'] = {'pool_share_token_address': config.BTC_PERP_SHARE_TOKEN_ADDRESS.lower(),
+                pool_info['BTC_PERP'] = {'pool_share_token_address': self._btc_perp_share_token_address,
                                         'pool_type': 'AMM',
                                         'pool_contract_inverse': False, 
                                         'amm_pool_proportion': little_pools_mean_proportion}
             amms_total_reward_percent = 0.5
             pool_reward_percent = amms_total_reward_percent
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
 
             # UNISWAP pool
             pool_info = {}
-            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': config.UNISWAP_MCB_ETH_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': self._uniswap_mcb_share_token_address,
                                             'pool_type': 'UNISWAP'}
             uniswap_mcb_reward_percent = 0.5
             pool_reward_percent = uniswap_mcb_reward_percent
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)            
+            layouts.append((pool_info, pool_reward_percent))            
         elif self._mining_round == 'HAN':
             # AMM pools, no reward in han period
             # UNISWAP pool
             pool_info = {}
-            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': config.UNISWAP_MCB_ETH_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['UNISWAP_MCB_ETH'] = {'pool_share_token_address': self._uniswap_mcb_share_token_address,
                                             'pool_type': 'UNISWAP'}
-            pool_info['UNISWAP_MCB_USDC'] = {'pool_share_token_address': config.UNISWAP_MCB_USDC_SHARE_TOKEN_ADDRESS.lower(),
+            pool_info['UNISWAP_MCB_USDC'] = {'pool_share_token_address': self._uniswap_mcb_usdc_share_token_address,
                                             'pool_type': 'UNISWAP'}                                            
             
             uniswap_mcb_reward_percent = 1
             pool_reward_percent = uniswap_mcb_reward_percent
-            self._calculate_pools_reward(block_number, pool_info, pool_reward_percent, db_session)
+            layouts.append((pool_info, pool_reward_percent))
+        return tuple(layouts)
+
+    def _rollback_chain_link_prices(self, block_number):
+        if block_number >= self._price_loaded_block:
+            return
+        for addr, price_blocks in self._price_blocks.items():
+            i = bisect.bisect_right(price_blocks, block_number)
+            del price_blocks[i:]
+            del self._prices[addr][i:]
+        self._price_loaded_block = block_number
 
     def rollback(self, watcher_id, block_number, db_session):
         """delete data after block_number"""
+        self._rollback_chain_link_prices(block_number)
         self._logger.info(f'rollback immature_mining_reward block_number back to {block_number}')
-        items = db_session.query(ImmatureMiningReward)\
-            .filter(ImmatureMiningReward.block_number > block_number)\
-            .filter(ImmatureMiningReward.mining_round == self._mining_round)\
-            .group_by(ImmatureMiningReward.pool_name, ImmatureMiningReward.holder, ImmatureMiningReward.mining_round)\
-            .with_entities(
-                ImmatureMiningReward.pool_name,
-                ImmatureMiningReward.holder,
-                ImmatureMiningReward.mining_round,
-                func.sum(ImmatureMiningReward.mcb_balance).label('mcb_balance')
-        ).all()
-        for item in items:
-            # update immature_mining_reward_summaries table
-            summary_item = db_session.query(ImmatureMiningRewardSummary)\
-                .filter(ImmatureMiningRewardSummary.holder == item.holder)\
-                .filter(ImmatureMiningRewardSummary.pool_name == item.pool_name)\
-                .filter(ImmatureMiningRewardSummary.mining_round == item.mining_round)\
-                    .first()
-            if summary_item is None:
-                self._logger.error(f'opps, update immature_mining_reward_summaries error, can not find item:{item}')
-            else:
-                summary_item.mcb_balance -= item.mcb_balance
-                db_session.add(summary_item)
+        if db_session.get_bind().dialect.name == 'postgresql':
+            # delete the rewards and subtract them from the summaries in one statement
+            result = db_session.execute(_ROLLBACK_IMMATURE_REWARDS_SQL, {
+                'block_number': block_number,
+                'mining_round': self._mining_round,
+            })
+            self._logger.info(f'rollback {result.rowcount} immature_mining_reward_summaries items')
+            return
+
+        rollback_filter = and_(
+            ImmatureMiningReward.block_number > block_number,
+            ImmatureMiningReward.mining_round == ImmatureMiningRewardSummary.mining_round,
+            ImmatureMiningReward.pool_name == ImmatureMiningRewardSummary.pool_name,
+            ImmatureMiningReward.holder == ImmatureMiningRewardSummary.holder,
+        )
+        rollback_reward = db_session.query(func.sum(ImmatureMiningReward.mcb_balance))\
+            .filter(rollback_filter)\
+            .correlate(ImmatureMiningRewardSummary)\
+            .as_scalar()
+        has_rollback_reward = db_session.query(ImmatureMiningReward)\
+            .filter(rollback_filter)\
+            .correlate(ImmatureMiningRewardSummary)\
+            .exists()
+        updated_count = db_session.query(ImmatureMiningRewardSummary)\
+            .filter(ImmatureMiningRewardSummary.mining_round == self._mining_round)\
+            .filter(has_rollback_reward)\
+            .update({ImmatureMiningRewardSummary.mcb_balance: ImmatureMiningRewardSummary.mcb_balance - rollback_reward},
+                    synchronize_session=False)
+        self._logger.info(f'rollback {updated_count} immature_mining_reward_summaries items')
 
         db_session.query(ImmatureMiningReward)\
             .filter(ImmatureMiningReward.block_number > block_number)\